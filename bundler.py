@@ -22,46 +22,74 @@ Notes
 - This script writes even if some lists are empty; check stdout summary for counts.
 """
 
-import argparse, re, sys
+import argparse, os, re, sys
 from pathlib import Path
 from collections import defaultdict, deque
+from functools import lru_cache
 
-EXCLUDE_DIRS = {".git", "build", "cmake-build-debug", ".pio", ".vscode", ".idea", "out", "dist"}
+EXCLUDE_DIRS = frozenset({".git", "build", "cmake-build-debug", ".pio", ".vscode", ".idea", "out", "dist"})
 HEADER_EXTS = {".h", ".hpp", ".hh", ".hxx"}
 SOURCE_EXTS = {".cpp", ".cc", ".cxx", ".ino"}  # .c intentionally excluded
-INCLUDE_RE  = re.compile(r'^\s*#\s*include\s*(<[^>]+>|"[^"]+")', re.M)
+INCLUDE_RE  = re.compile(r'^\s*#\s*include\s*(<[^>]+>|"[^"]+")', re.M | re.ASCII)
+# sources: \s* also swallows the blank lines around the include
+# headers: match within the line only, so surrounding blank lines are kept
+ARDUINO_H_INCLUDE_RE = re.compile(r'^\s*#\s*include\s*<Arduino\.h>\s*$', re.M)
+ARDUINO_H_LINE_RE    = re.compile(r'^[ \t]*#[ \t]*include[ \t]*<Arduino\.h>[ \t]*$', re.M)
 
 # --- type detection (for forward decls) ---
 # capture "struct Foo {" or "class Bar {" or with inheritance colon
-TYPE_DEF_RE = re.compile(r'^\s*(struct|class)\s+([A-Za-z_]\w*)\s*(?::|\{)', re.M)
-
-
-def is_excluded_dir(p: Path) -> bool:
-    return any(d in set(p.parts) for d in EXCLUDE_DIRS)
+TYPE_DEF_RE = re.compile(r'^\s*(struct|class)\s+([A-Za-z_]\w*)\s*(?::|\{)', re.M | re.ASCII)
 
 
 def scan_files(root: Path):
-    headers, sources = [], []
-    for p in root.rglob("*"):
-        if p.is_dir():
-            if p.name in EXCLUDE_DIRS:
-                continue
-        elif p.is_file():
-            if is_excluded_dir(p.parent):
-                continue
-            if p.suffix in HEADER_EXTS:
-                headers.append(p)
-            elif p.suffix in SOURCE_EXTS:
-                sources.append(p)
-    return headers, sources
+    # os.walk-style top-down walk over os.scandir: DirEntry types come from readdir,
+    # so pruning and file checks cost no extra stat() (only symlinks are followed)
+    headers, sources, symlinks = [], [], set()
+    stack = [os.fspath(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:  # unreadable dir: skip it, as os.walk does
+            continue
+        subdirs = []
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in EXCLUDE_DIRS:
+                        subdirs.append(entry.path)
+                    continue
+                ext = os.path.splitext(entry.name)[1].lower()
+                if ext not in HEADER_EXTS and ext not in SOURCE_EXTS:
+                    continue
+                if not entry.is_file():  # broken symlinks, FIFOs, etc.
+                    continue
+                p = Path(entry.path)
+                if ext in HEADER_EXTS:
+                    headers.append(p)
+                else:
+                    sources.append(p)
+                if entry.is_symlink():  # free from readdir; lets callers resolve() only these
+                    symlinks.add(p)
+        stack.extend(reversed(subdirs))
+    return headers, sources, symlinks
 
 
-def read_text(p: Path) -> str:
+@lru_cache(maxsize=None)
+def _read_text_cached(path_str: str) -> str:
     try:
-        return p.read_text(encoding="utf-8", errors="ignore")
+        text = Path(path_str).read_bytes().decode("utf-8", "ignore")
     except Exception as e:
-        print(f"[warn] failed to read {p}: {e}", file=sys.stderr)
+        print(f"[warn] failed to read {path_str}: {e}", file=sys.stderr)
         return ""
+    # match text-mode universal newlines, which the line-based regexes rely on
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def read_text(p: Path) -> str:
+    # headers/sources are consulted several times (graph, types, emission); hit disk once
+    return _read_text_cached(str(p))
 
 
 def parse_includes(text: str):
@@ -75,7 +103,7 @@ def parse_includes(text: str):
     return local_includes, external_includes
 
 
-def build_header_maps(headers):
+def build_header_maps(headers, symlinks=()):
     by_rel_or_full, by_name = {}, {}
     for p in headers:
         name = p.name
@@ -83,24 +111,44 @@ def build_header_maps(headers):
         rel = p.as_posix()
         by_rel_or_full[rel] = p
         by_rel_or_full[name] = p
+        # scanned paths are already real except file symlinks; key those by target too
+        if p in symlinks:
+            by_rel_or_full.setdefault(Path(os.path.realpath(p)).as_posix(), p)
     return by_rel_or_full, by_name
 
 
 def resolve_local_include(inc: str, base_dir: Path, hdr_map: dict):
-    cand = (base_dir / inc).resolve()
-    if cand.exists():
-        return cand
+    # hdr_map is keyed by each header's full posix path, so a lexical normpath
+    # lookup finds it without resolve()/exists() syscalls
+    cand = Path(os.path.normpath(os.path.join(base_dir, inc))).as_posix()
+    if cand in hdr_map:
+        return hdr_map[cand]
+    # miss: the path may still reach a header through a symlink (realpath costs syscalls,
+    # but only here)
+    real = Path(os.path.realpath(cand)).as_posix()
+    if real in hdr_map:
+        return hdr_map[real]
+    if os.path.exists(real):  # existing file outside the scanned headers; don't guess by name
+        return None
     norm = inc.replace("\\", "/")
     if norm in hdr_map:
         return hdr_map[norm]
     return hdr_map.get(Path(inc).name)
 
 # ----- header guard handling -----
-PRAGMA_ONCE_RE = re.compile(r'^\s*#\s*pragma\s+once\s*$', re.M)
-IFNDEF_RE      = re.compile(r'^\s*#\s*ifndef\s+([A-Za-z_]\w*)\s*$', re.M)
-DEFINE_RE_TPL  = r'^\s*#\s*define\s+{guard}\b.*$'
-ENDIF_RE       = re.compile(r'^\s*#\s*endif\b.*$', re.M)
-IF_ANY_RE      = re.compile(r'^\s*#\s*if(n?def)?\b', re.M)
+PRAGMA_ONCE_RE = re.compile(r'^\s*#\s*pragma\s+once\s*$', re.M | re.ASCII)
+IFNDEF_RE      = re.compile(r'^\s*#\s*ifndef\s+([A-Za-z_]\w*)\s*$', re.M | re.ASCII)
+ENDIF_RE       = re.compile(r'^\s*#\s*endif\b.*$', re.M | re.ASCII)
+IF_ANY_RE      = re.compile(r'^\s*#\s*if(?:n?def)?\b', re.M | re.ASCII)
+
+
+@lru_cache(maxsize=256)
+def _define_re(guard: str):
+    return re.compile(rf'^\s*#\s*define\s+{re.escape(guard)}\b.*$', re.M | re.ASCII)
+
+
+def _line_start(text: str, end: int) -> int:
+    return text.rfind("\n", 0, end) + 1
 
 
 def strip_header_guards_full(text: str) -> str:
@@ -109,73 +157,68 @@ def strip_header_guards_full(text: str) -> str:
         text = text.lstrip("\ufeff")
     text = PRAGMA_ONCE_RE.sub("", text)
 
-    lines = text.splitlines()
+    # Work on line offsets in the original string; guard lines are blanked by slicing
+    n = len(text)
+    def line_end(start: int) -> int:
+        e = text.find("\n", start)
+        return n if e < 0 else e
     # find first non-empty/comment line
     i = 0
     def ign(s: str) -> bool:
         st = s.strip()
         return (not st) or st.startswith("//") or st.startswith("/*") or st.startswith("*")
-    while i < len(lines) and ign(lines[i]):
-        i += 1
+    while i < n and ign(text[i:line_end(i)]):
+        i = line_end(i) + 1
 
-    if i < len(lines):
-        m_ifndef = IFNDEF_RE.match(lines[i])
+    if i < n:
+        start_if = (i, line_end(i))
+        m_ifndef = IFNDEF_RE.match(text, *start_if)
         if m_ifndef:
             guard = m_ifndef.group(1)
-            start_if = i
             # look for #define GUARD shortly after
-            max_probe = min(len(lines), i + 12)
             define_line = None
-            define_re = re.compile(DEFINE_RE_TPL.format(guard=re.escape(guard)))
-            for j in range(i + 1, max_probe):
-                if define_re.match(lines[j] or ""):
-                    define_line = j
+            define_re = _define_re(guard)
+            j = start_if[1] + 1
+            for _ in range(11):
+                if j >= n:
+                    break
+                e = line_end(j)
+                if define_re.match(text, j, e):
+                    define_line = (j, e)
                     break
+                j = e + 1
             if define_line is not None:
                 # find last #endif
                 end_idx = None
-                for k in range(len(lines) - 1, define_line, -1):
-                    if ENDIF_RE.match(lines[k] or ""):
-                        end_idx = k
-                        break
+                for m in ENDIF_RE.finditer(text, define_line[1] + 1):
+                    end_idx = (_line_start(text, m.end()), m.end())
                 if end_idx is not None:
-                    lines[start_if] = ""
-                    lines[define_line] = ""
-                    lines[end_idx] = ""
-                    text = "\n".join(lines)
-                else:
-                    text = "\n".join(lines)
-            else:
-                text = "\n".join(lines)
-        else:
-            text = "\n".join(lines)
-    else:
-        text = "\n".join(lines)
+                    text = (
+                        text[:start_if[0]] + text[start_if[1]:define_line[0]]
+                        + text[define_line[1]:end_idx[0]] + text[end_idx[1]:]
+                    )
 
     # Safety: drop extra trailing #endif if more endif than if/ifdef/ifndef
-    if_count    = len(IF_ANY_RE.findall(text))
-    endif_count = len(ENDIF_RE.findall(text))
-    if endif_count > if_count:
-        diff = endif_count - if_count
-        L = text.splitlines()
-        for idx in range(len(L) - 1, -1, -1):
-            if diff == 0:
-                break
-            if ENDIF_RE.match(L[idx] or ""):
-                L[idx] = "// [removed stray #endif]"
-                diff -= 1
-        text = "\n".join(L)
+    if_count = len(IF_ANY_RE.findall(text))
+    endifs   = list(ENDIF_RE.finditer(text))
+    diff = len(endifs) - if_count
+    if diff > 0:
+        parts, last = [], 0
+        for m in endifs[-diff:]:
+            parts.append(text[last:_line_start(text, m.end())])
+            parts.append("// [removed stray #endif]")
+            last = m.end()
+        parts.append(text[last:])
+        text = "".join(parts)
 
     return text
 
 # ----- header graph & order -----
 
-def graph_headers(headers):
-    hdr_lookup_full, _ = build_header_maps(headers)
+def graph_headers(headers, hdr_lookup_full: dict, parsed: dict):
     deps, nodes = defaultdict(set), set(headers)
     for h in headers:
-        text = read_text(h)
-        locals_, _ = parse_includes(text)
+        locals_, _ = parsed[h]
         for inc in locals_:
             t = resolve_local_include(inc, h.parent, hdr_lookup_full)
             if t and t in nodes:
@@ -202,22 +245,14 @@ def topo_sort(nodes, deps):
             indeg[u] -= 1
             if indeg[u] == 0:
                 q.append(u)
-    if len(order) < len(nodes):  # cycle fallback
-        remaining = [u for u in nodes if u not in order]
-        order.extend(remaining)
+    if len(order) < len(indeg):  # cycle fallback: unplaced nodes still have indegree left
+        order.extend(u for u, d in indeg.items() if d > 0)
     return order
 
 
-def dedup(seq):
-    seen, out = set(), []
-    for x in seq:
-        if x not in seen:
-            seen.add(x)
-            out.append(x)
-    return out
-
-
-def strip_local_includes(text: str, base: Path, hdr_map_full: dict):
+def strip_local_includes(text: str, base: Path, hdr_map_full: dict, has_local: bool = True):
+    if not has_local:  # nothing to comment out; skip the regex pass
+        return text
     def repl(m):
         token = m.group(1)
         if token.startswith('"'):
@@ -225,17 +260,26 @@ def strip_local_includes(text: str, base: Path, hdr_map_full: dict):
             if resolve_local_include(inc, base, hdr_map_full):
                 return f"// [inlined: {inc}]"
         return m.group(0)
-    return re.sub(r'^\s*#\s*include\s*(<[^>]+>|"[^"]+")', repl, text, flags=re.M)
+    return INCLUDE_RE.sub(repl, text)
+
+
+def dedup_arduino_h(text: str, pattern=ARDUINO_H_INCLUDE_RE) -> str:
+    if "Arduino.h" not in text:
+        return text
+    return pattern.sub('// [dedup Arduino.h]', text)
 
 
 # --- Collect user-defined types for forward decls ---
 
+@lru_cache(maxsize=None)
+def _types_in(path_str: str):
+    return tuple((m.group(1), m.group(2)) for m in TYPE_DEF_RE.finditer(_read_text_cached(path_str)))
+
+
 def collect_user_types(files):
     kinds = {}  # name -> 'struct' or 'class' (first seen wins)
     for p in files:
-        txt = read_text(p)
-        for m in TYPE_DEF_RE.finditer(txt):
-            kind, name = m.group(1), m.group(2)
+        for kind, name in _types_in(str(p)):
             if name in {"String"}:  # skip Arduino String
                 continue
             kinds.setdefault(name, kind)
@@ -252,9 +296,11 @@ def main():
     root = Path(args.root).resolve()
     out_path = Path(args.out).resolve()
 
-    headers, sources = scan_files(root)
-    ino_files = [p for p in sources if p.suffix == ".ino"]
-    cpp_files = [p for p in sources if p.suffix != ".ino"]
+    headers, sources, symlinks = scan_files(root)
+    # One include parse per project file: path -> (local_includes, external_includes)
+    parsed = {p: parse_includes(read_text(p)) for p in headers + sources}
+    ino_files = [p for p in sources if p.suffix.lower() == ".ino"]
+    cpp_files = [p for p in sources if p.suffix.lower() != ".ino"]
 
     # Resolve entry (can be .ino or .cpp)
     entry_file = None
@@ -263,18 +309,16 @@ def main():
         if not entry_file.exists():
             print(f"[warn] --entry not found: {entry_file}", file=sys.stderr)
             entry_file = None
+        elif entry_file not in parsed:  # e.g. an entry inside an excluded dir
+            parsed[entry_file] = parse_includes(read_text(entry_file))
 
     # Build header order
-    nodes, deps = graph_headers(headers)
+    hdr_map_full, _ = build_header_maps(headers, symlinks)
+    nodes, deps = graph_headers(headers, hdr_map_full, parsed)
     hdr_order = topo_sort(list(nodes), deps)
-    hdr_map_full, _ = build_header_maps(headers)
 
     # Collect external includes from ALL project files
-    external_pool = []
-    for p in headers + sources:
-        _, exts = parse_includes(read_text(p))
-        external_pool.extend(exts)
-    external_pool = dedup(external_pool)
+    external_pool = list(dict.fromkeys(e for p in headers + sources for e in parsed[p][1]))
     if "Arduino.h" in external_pool:
         external_pool = ["Arduino.h"] + [x for x in external_pool if x != "Arduino.h"]
     else:
@@ -283,71 +327,61 @@ def main():
     # Collect user-defined types (struct/class) for forward decls
     user_types = collect_user_types(headers + sources)
     priority = ["DisplayState", "PomodoroState", "EncoderState"]
-    ordered_types = [n for n in priority if n in user_types] + [n for n in sorted(user_types) if n not in priority]
+    priority_set = frozenset(priority)
+    ordered_types = [n for n in priority if n in user_types] + [n for n in sorted(user_types) if n not in priority_set]
 
     chunks = []
     chunks.append("// Auto-generated single-file for Wokwi\n")
-    for inc in external_pool:
-        chunks.append(f"#include <{inc}>\n")
-    chunks.append("\n")
+    chunks.append("\n".join(f"#include <{inc}>" for inc in external_pool) + "\n\n")
 
     # Forward declarations (to satisfy auto-prototyper)
     if ordered_types:
         chunks.append("// ---- Forward declarations (for Arduino auto-prototyper) ----\n")
-        for name in ordered_types:
-            kind = user_types[name]
-            chunks.append(f"{kind} {name};\n")
-        chunks.append("\n")
+        chunks.append("\n".join(f"{user_types[name]} {name};" for name in ordered_types) + "\n\n")
 
     # Inline headers (guard-stripped, local includes commented)
     for h in hdr_order:
         text = strip_header_guards_full(read_text(h))
-        text = strip_local_includes(text, h.parent, hdr_map_full)
+        text = strip_local_includes(text, h.parent, hdr_map_full, bool(parsed[h][0]))
+        text = dedup_arduino_h(text, ARDUINO_H_LINE_RE)
         chunks.append(f"// ===== HEADER: {h.relative_to(root)} =====\n{text.strip()}\n\n")
 
     # Exclude entry file from intermediate emissions
+    # (scanned paths sit under the resolved root and dir symlinks are not followed, so only
+    #  file symlinks recorded by scan_files need resolve() to match the resolved entry_file)
     if entry_file:
-        ino_files = [p for p in ino_files if p.resolve() != entry_file.resolve()]
-        cpp_files = [p for p in cpp_files if p.resolve() != entry_file.resolve()]
+        def is_entry(p: Path) -> bool:
+            return p == entry_file or (p in symlinks and p.resolve() == entry_file)
+        ino_files = [p for p in ino_files if not is_entry(p)]
+        cpp_files = [p for p in cpp_files if not is_entry(p)]
 
     # Non-entry .ino helpers
     for p in ino_files:
         t = read_text(p)
-        t = strip_local_includes(t, p.parent, hdr_map_full)
-        t = re.sub(r'^\s*#\s*include\s*<Arduino\.h>\s*$', '// [dedup Arduino.h]', t, flags=re.M)
+        t = strip_local_includes(t, p.parent, hdr_map_full, bool(parsed[p][0]))
+        t = dedup_arduino_h(t)
         chunks.append(f"// ===== INO: {p.relative_to(root)} =====\n{t.strip()}\n\n")
 
     # .cpp sources
     for p in cpp_files:
         t = read_text(p)
-        t = strip_local_includes(t, p.parent, hdr_map_full)
-        t = re.sub(r'^\s*#\s*include\s*<Arduino\.h>\s*$', '// [dedup Arduino.h]', t, flags=re.M)
+        t = strip_local_includes(t, p.parent, hdr_map_full, bool(parsed[p][0]))
+        t = dedup_arduino_h(t)
         chunks.append(f"// ===== SOURCE: {p.relative_to(root)} =====\n{t.strip()}\n\n")
 
     # Entry file last (if given)
     if entry_file:
         t = read_text(entry_file)
-        t = strip_local_includes(t, entry_file.parent, hdr_map_full)
-        t = re.sub(r'^\s*#\s*include\s*<Arduino\.h>\s*$', '// [dedup Arduino.h]', t, flags=re.M)
+        t = strip_local_includes(t, entry_file.parent, hdr_map_full, bool(parsed[entry_file][0]))
+        t = dedup_arduino_h(t)
         chunks.append(f"// ===== ENTRY: {entry_file.relative_to(root)} =====\n{t.strip()}\n\n")
 
-    # Final Arduino.h dedup (safety)
-    seen = False
-    lines = []
-    for line in "".join(chunks).splitlines():
-        if re.match(r'\s*#\s*include\s*<Arduino\.h>\s*$', line):
-            if seen:
-                lines.append("// [dedup Arduino.h]")
-            else:
-                seen = True
-                lines.append(line)
-        else:
-            lines.append(line)
-    joined = "\n".join(lines) + "\n"
-
     # Ensure parent dir exists
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(joined, encoding="utf-8")
+    # Arduino.h is emitted once at the top; every inlined file has its own copy commented out,
+    # so chunks are written as-is without joining the whole bundle in memory
+    with open(out_path, "w", encoding="utf-8") as f:
+        f.writelines(chunks)
 
     print(
         f"[ok] wrote {out_path} with "